@@ -1,19 +1,125 @@
-import torch, hashlib
-from typing import Dict, Union, Tuple, List, Any
+import torch, os, threading, weakref
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Deque, Dict, Union, Tuple, List, Any
+from typing import OrderedDict as OrderedDictType
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# Maximum number of cached encodings per node type, read once at import
+try:
+    CACHE_LIMIT = max(1, int(os.environ.get("COMFY_CLIP_CACHE_LIMIT", "10")))
+except ValueError:
+    CACHE_LIMIT = 10
+
+# Kept as an ignored input so widget values of saved workflows stay in place
+DEPRECATED_CACHE_LIMIT_INPUT = ("INT", {"default": 10, "min": 1, "max": 100, "tooltip": "Deprecated and ignored, set the COMFY_CLIP_CACHE_LIMIT environment variable instead."})
+
+# FLUX consumes conditioning in bf16, so the FLUX node caches it as bf16
+CACHE_DTYPE = torch.bfloat16
+
+def _to_cache_dtype(value: Any) -> Any:
+    """Downcast full-precision floating point tensors to CACHE_DTYPE, leave anything else as is."""
+    if isinstance(value, torch.Tensor) and value.is_floating_point() and value.element_size() > 2:
+        return value.to(CACHE_DTYPE)
+    return value
+
+@dataclass(slots=True)
+class CacheEntry:
+    """Cached encoding of prompt texts for a single CLIP model."""
+    clip_id: int
+    texts: Tuple[str, ...]
+    device: torch.device
+    cond: torch.Tensor
+    pooled_output: Dict[str, Any]
+
+def _to_pinned_cpu(value: Any) -> Any:
+    """Copy a CUDA tensor into pinned host memory, leave anything else as is."""
+    if isinstance(value, torch.Tensor) and value.is_cuda:
+        pinned = torch.empty(value.shape, dtype=value.dtype, device="cpu", pin_memory=True)
+        pinned.copy_(value, non_blocking=True)
+        return pinned
+    return value
+
+def _to_device(value: Any, device: torch.device) -> Any:
+    """Move a tensor to the given device without blocking the host, leave anything else as is."""
+    if isinstance(value, torch.Tensor) and value.device != device:
+        return value.to(device, non_blocking=True)
+    return value
+
+def _offload_entry(entry: CacheEntry) -> None:
+    """Move cached tensors of a cold entry from VRAM to pinned host memory."""
+    entry.cond = _to_pinned_cpu(entry.cond)
+    entry.pooled_output = {key: _to_pinned_cpu(value) for key, value in entry.pooled_output.items()}
+
+def _restore_entry(entry: CacheEntry) -> None:
+    """Move cached tensors of an entry back to the device they were encoded on."""
+    device = entry.device
+    entry.cond = _to_device(entry.cond, device)
+    entry.pooled_output = {key: _to_device(value, device) for key, value in entry.pooled_output.items()}
+
+# Tokenization results shared by all nodes, keyed by tokenizer identity, tokenizer options and text
+TOKENS_CACHE_LIMIT = 64
+_tokens_cache: OrderedDictType[Tuple[int, Tuple[Tuple[str, Any], ...], str], Tuple[weakref.ref, Dict[str, Any]]] = OrderedDict()
+_tokens_lock = threading.Lock()
+
+def _tokenize(clip: Any, text: str) -> Dict[str, Any]:
+    """Tokenize text with the CLIP tokenizer, reusing a previous result for the same tokenizer, options and text."""
+    tokenizer = clip.tokenizer
+
+    # Cloned CLIPs share the tokenizer but may carry their own tokenizer options, e.g. T5 min_padding
+    options = tuple(sorted(getattr(clip, "tokenizer_options", {}).items()))
+    key = (id(tokenizer), options, text)
+
+    with _tokens_lock:
+        cached = _tokens_cache.get(key)
+
+        # Tokenizer is held weakly so a reused id of a dead tokenizer can't return stale tokens
+        if cached is not None and cached[0]() is tokenizer:
+            _tokens_cache.move_to_end(key)
+            return dict(cached[1])
+
+        tokens = clip.tokenize(text)
+        _tokens_cache[key] = (weakref.ref(tokenizer), tokens)
+        while len(_tokens_cache) > TOKENS_CACHE_LIMIT:
+            _tokens_cache.popitem(last=False)
+
+        # Return a shallow copy as callers may replace keys of the tokens dict
+        return dict(tokens)
+
+def _new_hasher() -> Any:
+    """Create a streaming 64-bit hasher, preferring xxh3 over blake2b."""
+    if xxhash is not None:
+        return xxhash.xxh3_64()
+
+    # hashlib is only needed when xxhash is not installed, so it is imported lazily
+    import hashlib
+    return hashlib.blake2b(digest_size=8)
+
+def _hash_parts(*parts: Union[str, bytes]) -> int:
+    """Generate a fast non-cryptographic 64-bit hash of all parts and return as int."""
+    hasher = _new_hasher()
+    for part in parts:
+        data = part.encode() if isinstance(part, str) else part
+        # Prefix every part with its length so ("ab", "c") and ("a", "bc") hash differently
+        hasher.update(len(data).to_bytes(8, "little"))
+        hasher.update(data)
+    if xxhash is not None:
+        return hasher.intdigest()
+    return int.from_bytes(hasher.digest(), "little")
 
 class CachingCLIPTextEncode:
     """A caching CLIP text encoder that stores previous encodings to avoid redundant processing."""
 
-    def __init__(self) -> None:
-        self.cache_limit = 10
-        self.cache: Dict[str, Dict[str, Union[str, torch.Tensor, None]]] = {
-            "hash": {
-                "clip_address": None,
-                "text": None,
-                "cond": None,
-                "pooled_output": None,
-            },
-        }
+    # Cache is shared by all instances, so it survives ComfyUI re-creating nodes between runs
+    cache: OrderedDictType[int, CacheEntry] = OrderedDict()
+    _lock = threading.Lock()
+    _finalizers: Dict[int, weakref.finalize] = {}
+    _purged: Deque[int] = deque()
+    _last: Union[Tuple[int, str, torch.Tensor, Dict[str, Any]], None] = None
     
     @classmethod
     def INPUT_TYPES(s):
@@ -21,7 +127,7 @@ class CachingCLIPTextEncode:
             "required": {
                 "text": ("STRING", {"multiline": True, "dynamicPrompts": True, "tooltip": "The text to be encoded."}), 
                 "clip": ("CLIP", {"tooltip": "The CLIP model used for encoding the text."}),
-                "cache_limit": ("INT", {"default": 10, "min": 1, "max": 100}),
+                "cache_limit": DEPRECATED_CACHE_LIMIT_INPUT,
             }
         }
     
@@ -32,78 +138,126 @@ class CachingCLIPTextEncode:
     CATEGORY = "conditioning"
     DESCRIPTION = "Encodes a text prompt using a CLIP model into an embedding that can be used to guide the diffusion model towards generating specific images."
 
-    def get_text_hash(self, text: str) -> str:
-        """Generate SHA-256 hash of input text and return as hex string."""
-        return hashlib.sha256(text.encode()).hexdigest()
+    def get_text_hash(self, *parts: Union[str, bytes]) -> int:
+        """Generate fast 64-bit hash of input text parts and return as int."""
+        return _hash_parts(*parts)
 
-    def encode(self, clip: Any, text: str, cache_limit: int) -> Tuple[List[List[Any]], ...]:
+    @classmethod
+    def _purge_clips(cls) -> None:
+        """Remove all cache entries of CLIP models that have been garbage collected."""
+        while cls._purged:
+            clip_id = cls._purged.popleft()
+            for text_hash in [key for key, entry in cls.cache.items() if entry.clip_id == clip_id]:
+                del cls.cache[text_hash]
+            if cls._last is not None and cls._last[0] == clip_id:
+                cls._last = None
+            cls._finalizers.pop(clip_id, None)
+
+    def encode(self, clip: Any, text: str, cache_limit: int = CACHE_LIMIT) -> Tuple[List[List[Any]], ...]:
         """
         Encode text using CLIP with caching mechanism.
         
         Args:
             clip: CLIP model instance
             text: Main CLIP text input
-            cache_limit: Limit cache size to avoid excessive memory usage
+            cache_limit: Deprecated and ignored, COMFY_CLIP_CACHE_LIMIT is used instead
             
         Returns:
             Tuple containing conditioning and pooled outputs
         """
-        
-        # Update cache limit
-        self.cache_limit = cache_limit
-        cache_len = len(self.cache)
-
-        # Generate hash for input text
-        clip_address = str(id(clip))
-        text_hash = self.get_text_hash(text + clip_address)
-
-        # Check if hash exists in cache dictionary
-        if text_hash in self.cache:
-                
-                # Check if address of clip object is the same. It's required if you switch CLIP model that renders cached data invalid.
-                if clip_address == self.cache[text_hash]["clip_address"]:
-                    
-                    # Return cached data if text matches
-                    return ([[self.cache[text_hash]["cond"], self.cache[text_hash]["pooled_output"]]], )
-
-        # Generate new encodings if inputs changed
-        tokens = clip.tokenize(text)
-        output = clip.encode_from_tokens(tokens, return_pooled=True, return_dict=True)
-        cond = output.pop("cond")
-
-        # Create new cache entry for this hash
-        self.cache[text_hash] = {
-            "clip_address": clip_address,
-            "text": text,
-            "cond": cond,
-            "pooled_output": output
-        }
 
-        # Check cache size and remove oldest entry if limit reached
-        if cache_len >= cache_limit:
-            first_key = next(iter(self.cache))
-            del self.cache[first_key]
+        with self._lock:
+            # Drop entries of CLIP models collected since the last call
+            self._purge_clips()
+
+            clip_id = id(clip)
+
+            # Skip hashing if the same text and clip were requested last time
+            last = self._last
+            if last is not None and last[0] == clip_id and last[1] == text:
+                return ([[last[2], last[3]]], )
+
+            # Small caches are searched by direct comparison, as it is cheaper than hashing
+            text_hash = None
+            if len(self.cache) <= 2:
+                texts = (text, )
+                for key, entry in self.cache.items():
+                    if entry.clip_id == clip_id and entry.texts == texts:
+                        text_hash = key
+                        break
 
-        return ([[cond, output]], )
+            # Generate hash for input text
+            if text_hash is None:
+                text_hash = self.get_text_hash(text, clip_id.to_bytes(8, "little"))
+
+            # Move the previously most recent entry to pinned host memory as it is going cold now
+            if self.cache and CACHE_LIMIT > 1:
+                last_hash = next(reversed(self.cache))
+                if last_hash != text_hash:
+                    _offload_entry(self.cache[last_hash])
+
+            # Check if hash exists in cache dictionary
+            if text_hash in self.cache:
+
+                    # Check if address of clip object is the same. It's required if you switch CLIP model that renders cached data invalid.
+                    if clip_id == self.cache[text_hash].clip_id:
+
+                        # Mark entry as most recently used and bring it back to its device if it was offloaded
+                        self.cache.move_to_end(text_hash)
+                        _restore_entry(self.cache[text_hash])
+
+                        # Return cached data if text matches
+                        entry = self.cache[text_hash]
+                        type(self)._last = (clip_id, text, entry.cond, entry.pooled_output)
+                        return ([[entry.cond, entry.pooled_output]], )
+
+            # Generate new encodings if inputs changed
+            with torch.inference_mode():
+                tokens = _tokenize(clip, text)
+                output = clip.encode_from_tokens(tokens, return_pooled=True, return_dict=True)
+
+            # Drop autograd metadata so cached tensors don't keep a graph alive
+            cond = output.pop("cond").detach()
+
+            # Create new cache entry for this hash
+            self.cache[text_hash] = CacheEntry(clip_id, (text, ), cond.device, cond, output)
+
+            # Drop entries of this CLIP model once it is garbage collected, so its tensors don't linger and its id can't be reused.
+            # Finalizer only queues the id, as it may run in the middle of a cache update
+            if clip_id not in self._finalizers:
+                self._finalizers[clip_id] = weakref.finalize(clip, self._purged.append, clip_id)
+
+            # Remove least recently used entries until cache fits the limit
+            while len(self.cache) > CACHE_LIMIT:
+                self.cache.popitem(last=False)
+
+            type(self)._last = (clip_id, text, cond, output)
+            return ([[cond, output]], )
 
 class CachingCLIPTextEncodeFlux:
     """A caching CLIP text encoder for FLUX that stores previous encodings to avoid redundant processing."""
     
-    def __init__(self) -> None:
-        self.cache_limit = 10
-        self.cache: Dict[str, Dict[str, Union[str, torch.Tensor, None]]] = {
-            "hash": {
-                "clip_address": None,
-                "clip_l": None,
-                "t5xxl": None,
-                "cond": None,
-                "pooled_output": None,
-            },
-        }
+    # Cache is shared by all instances, so it survives ComfyUI re-creating nodes between runs
+    cache: OrderedDictType[int, CacheEntry] = OrderedDict()
+    _lock = threading.Lock()
+    _finalizers: Dict[int, weakref.finalize] = {}
+    _purged: Deque[int] = deque()
+    _last: Union[Tuple[int, str, str, torch.Tensor, Dict[str, Any]], None] = None
 
-    def get_text_hash(self, text: str) -> str:
-        """Generate SHA-256 hash of input text and return as hex string."""
-        return hashlib.sha256(text.encode()).hexdigest()
+    def get_text_hash(self, *parts: Union[str, bytes]) -> int:
+        """Generate fast 64-bit hash of input text parts and return as int."""
+        return _hash_parts(*parts)
+
+    @classmethod
+    def _purge_clips(cls) -> None:
+        """Remove all cache entries of CLIP models that have been garbage collected."""
+        while cls._purged:
+            clip_id = cls._purged.popleft()
+            for text_hash in [key for key, entry in cls.cache.items() if entry.clip_id == clip_id]:
+                del cls.cache[text_hash]
+            if cls._last is not None and cls._last[0] == clip_id:
+                cls._last = None
+            cls._finalizers.pop(clip_id, None)
     
     @classmethod
     def INPUT_TYPES(s):
@@ -112,7 +266,7 @@ class CachingCLIPTextEncodeFlux:
                 "clip": ("CLIP", ),
                 "clip_l": ("STRING", {"multiline": True, "dynamicPrompts": True}),
                 "t5xxl": ("STRING", {"multiline": True, "dynamicPrompts": True}),
-                "cache_limit": ("INT", {"default": 10, "min": 1, "max": 100}),
+                "cache_limit": DEPRECATED_CACHE_LIMIT_INPUT,
                 "guidance": ("FLOAT", {
                     "default": 3.5,
                     "min": 0.0,
@@ -126,7 +280,7 @@ class CachingCLIPTextEncodeFlux:
     FUNCTION = "encode"
     CATEGORY = "advanced/conditioning/flux"
 
-    def encode(self, clip: Any, clip_l: str, t5xxl: str, guidance: float, cache_limit: int) -> Tuple[List[List[Any]], ...]:
+    def encode(self, clip: Any, clip_l: str, t5xxl: str, guidance: float, cache_limit: int = CACHE_LIMIT) -> Tuple[List[List[Any]], ...]:
         """
         Encode text using CLIP with caching mechanism.
         
@@ -134,56 +288,85 @@ class CachingCLIPTextEncodeFlux:
             clip: CLIP model instance
             clip_l: Main CLIP text input
             t5xxl: T5XXL text input
-            cache_limit: Limit cache size to avoid excessive memory usage
+            cache_limit: Deprecated and ignored, COMFY_CLIP_CACHE_LIMIT is used instead
             guidance: Guidance scale for conditioning
             
         Returns:
             Tuple containing conditioning and pooled outputs
         """
 
-        # Update cache limit
-        self.cache_limit = cache_limit
-        cache_len = len(self.cache)
+        with self._lock:
+            # Drop entries of CLIP models collected since the last call
+            self._purge_clips()
 
-        # Generate hash for input text
-        clip_address = str(id(clip))
-        text_hash = self.get_text_hash(clip_l + t5xxl + clip_address)
+            clip_id = id(clip)
 
-        # Check if hash exists in cache dictionary
-        if text_hash in self.cache:
-                
-                # Check if address of clip object is the same. It's required if you switch CLIP model that renders cached data invalid.
-                if clip_address == self.cache[text_hash]["clip_address"]:
-        
-                    # Adjust guidance as it may change by user
-                    self.cache[text_hash]["guidance"] = guidance
-            
-                    # Return cached data if text matches
-                    return ([[self.cache[text_hash]["cond"], self.cache[text_hash]["pooled_output"]]], )
-
-        # Generate new encodings if inputs changed
-        tokens = clip.tokenize(clip_l)
-        tokens["t5xxl"] = clip.tokenize(t5xxl)["t5xxl"]
-
-        output = clip.encode_from_tokens(tokens, return_pooled=True, return_dict=True)
-        cond = output.pop("cond")
-        output["guidance"] = guidance
-
-        # Create new cache entry for this hash
-        self.cache[text_hash] = {
-            "clip_address": clip_address,
-            "clip_l": clip_l,
-            "t5xxl": t5xxl,
-            "cond": cond,
-            "pooled_output": output
-        }
+            # Skip hashing if the same texts and clip were requested last time
+            last = self._last
+            if last is not None and last[0] == clip_id and last[1] == clip_l and last[2] == t5xxl:
+                return ([[last[3], {**last[4], "guidance": guidance}]], )
+
+            # Small caches are searched by direct comparison, as it is cheaper than hashing
+            text_hash = None
+            if len(self.cache) <= 2:
+                texts = (clip_l, t5xxl)
+                for key, entry in self.cache.items():
+                    if entry.clip_id == clip_id and entry.texts == texts:
+                        text_hash = key
+                        break
+
+            # Generate hash for input text
+            if text_hash is None:
+                text_hash = self.get_text_hash(clip_l, t5xxl, clip_id.to_bytes(8, "little"))
+
+            # Move the previously most recent entry to pinned host memory as it is going cold now
+            if self.cache and CACHE_LIMIT > 1:
+                last_hash = next(reversed(self.cache))
+                if last_hash != text_hash:
+                    _offload_entry(self.cache[last_hash])
+
+            # Check if hash exists in cache dictionary
+            if text_hash in self.cache:
+
+                    # Check if address of clip object is the same. It's required if you switch CLIP model that renders cached data invalid.
+                    if clip_id == self.cache[text_hash].clip_id:
+
+                        # Mark entry as most recently used and bring it back to its device if it was offloaded
+                        self.cache.move_to_end(text_hash)
+                        _restore_entry(self.cache[text_hash])
+
+                        # Return cached data if text matches
+                        entry = self.cache[text_hash]
+                        type(self)._last = (clip_id, clip_l, t5xxl, entry.cond, entry.pooled_output)
+
+                        # Guidance may be changed by user, so it is added to a fresh dict instead of the cached one
+                        return ([[entry.cond, {**entry.pooled_output, "guidance": guidance}]], )
+
+            # Generate new encodings if inputs changed
+            with torch.inference_mode():
+                tokens = _tokenize(clip, clip_l)
+                tokens["t5xxl"] = _tokenize(clip, t5xxl)["t5xxl"]
+
+                output = clip.encode_from_tokens(tokens, return_pooled=True, return_dict=True)
+
+            # Drop autograd metadata so cached tensors don't keep a graph alive and store them in half precision
+            cond = _to_cache_dtype(output.pop("cond").detach())
+            output = {key: _to_cache_dtype(value) for key, value in output.items()}
+
+            # Create new cache entry for this hash
+            self.cache[text_hash] = CacheEntry(clip_id, (clip_l, t5xxl), cond.device, cond, output)
+
+            # Drop entries of this CLIP model once it is garbage collected, so its tensors don't linger and its id can't be reused.
+            # Finalizer only queues the id, as it may run in the middle of a cache update
+            if clip_id not in self._finalizers:
+                self._finalizers[clip_id] = weakref.finalize(clip, self._purged.append, clip_id)
 
-        # Check cache size and remove oldest entry if limit reached
-        if cache_len >= cache_limit:
-            first_key = next(iter(self.cache))
-            del self.cache[first_key]
+            # Remove least recently used entries until cache fits the limit
+            while len(self.cache) > CACHE_LIMIT:
+                self.cache.popitem(last=False)
 
-        return ([[cond, output]], )
+            type(self)._last = (clip_id, clip_l, t5xxl, cond, output)
+            return ([[cond, {**output, "guidance": guidance}]], )
 
 NODE_CLASS_MAPPINGS = {
     "CachingCLIPTextEncodeFlux|ARZUMATA": CachingCLIPTextEncodeFlux,